@@ -1,5 +1,9 @@
+import copy
+from concurrent import futures
+
 import napari
 import numpy as np
+import torch
 
 from magicgui import magicgui
 from napari import Viewer
@@ -33,18 +37,45 @@ def _segment_volume(
     else:
         use_mask, use_box = False, True
 
-    def _update_progress():
-        if progress_bar is not None:
-            progress_bar.update(1)
+    # the progress bar drives a qt widget, so it must only be updated from the
+    # main thread; the tasks below just count their segmented slices and the
+    # counts are applied here once each task completes
+    def _update_progress(n_segmented):
+        if progress_bar is not None and n_segmented > 0:
+            progress_bar.update(n_segmented)
+
+    # block size for pre-loading the image embeddings in segment_range
+    embedding_block_size = 8
 
     # TODO refactor to utils so that it can be used by other plugins
-    def segment_range(z_start, z_stop, increment, stopping_criterion, threshold=None, verbose=False):
+    def segment_range(predictor_, z_start, z_stop, increment, stopping_criterion, threshold=None, verbose=False):
+        features = image_embeddings["features"]
+        block_embeddings, block_start = None, None
+
+        # load the embeddings in blocks of consecutive slices, so that successive
+        # segment_from_mask calls read from a block that is already in memory
+        # instead of re-reading the zarr chunks slice by slice
+        def get_block_embeddings(z):
+            nonlocal block_embeddings, block_start
+            this_start = (z // embedding_block_size) * embedding_block_size
+            if block_start != this_start:
+                this_stop = min(this_start + embedding_block_size, seg.shape[0])
+                block_embeddings = {
+                    "features": features[this_start:this_stop],
+                    "input_size": image_embeddings["input_size"],
+                    "original_size": image_embeddings["original_size"],
+                }
+                block_start = this_start
+            return block_embeddings, z - this_start
+
         z = z_start + increment
+        n_segmented = 0
         while True:
             if verbose:
                 print(f"Segment {z_start} to {z_stop}: segmenting slice {z}")
             seg_prev = seg[z - increment]
-            seg_z = segment_from_mask(predictor, seg_prev, image_embeddings=image_embeddings, i=z,
+            embeddings_z, i_z = get_block_embeddings(z)
+            seg_z = segment_from_mask(predictor_, seg_prev, image_embeddings=embeddings_z, i=i_z,
                                       use_mask=use_mask, use_box=use_box)
             if threshold is not None:
                 iou = util.compute_iou(seg_prev, seg_z)
@@ -58,57 +89,92 @@ def _segment_volume(
                 if verbose:
                     print(f"Segment {z_start} to {z_stop}: stop at slice {z}")
                 break
-            _update_progress()
+            n_segmented += 1
+        return n_segmented
+
+    def segment_inbetween(predictor_, z_start, z_stop, verbose=False):
+        slice_diff = z_stop - z_start
+        z_mid = int((z_start + z_stop) // 2)
+        # scratch buffer for the combined mask prompts
+        # (allocated per task, because the tasks may run concurrently)
+        mask_scratch = np.empty(seg.shape[1:], dtype="bool")
+        n_segmented = 0
+
+        if slice_diff == 1:  # the slices are adjacent -> we don't need to do anything
+            pass
+
+        elif z_start == z0 and stop_lower:  # the lower slice is stop: we just segment from upper
+            n_segmented += segment_range(predictor_, z_stop, z_start, -1, np.less_equal, verbose=verbose)
+
+        elif z_stop == z1 and stop_upper:  # the upper slice is stop: we just segment from lower
+            n_segmented += segment_range(predictor_, z_start, z_stop, 1, np.greater_equal, verbose=verbose)
+
+        elif slice_diff == 2:  # there is only one slice in between -> use combined mask
+            z = z_start + 1
+            seg_prompt = util._mask_union(seg[z_start], seg[z_stop], out=mask_scratch)
+            seg[z] = segment_from_mask(predictor_, seg_prompt, image_embeddings=image_embeddings, i=z,
+                                       use_mask=use_mask, use_box=use_box)
+            n_segmented += 1
+
+        else:  # there is a range of more than 2 slices in between -> segment ranges
+            # segment from bottom
+            n_segmented += segment_range(
+                predictor_, z_start, z_mid, 1, np.greater_equal if slice_diff % 2 == 0 else np.greater, verbose=verbose
+            )
+            # segment from top
+            n_segmented += segment_range(predictor_, z_stop, z_mid, -1, np.less_equal, verbose=verbose)
+            # if the difference between start and stop is even,
+            # then we have a slice in the middle that is the same distance from top bottom
+            # in this case the slice is not segmented in the ranges above, and we segment it
+            # using the combined mask from the adjacent top and bottom slice as prompt
+            if slice_diff % 2 == 0:
+                seg_prompt = util._mask_union(seg[z_mid - 1], seg[z_mid + 1], out=mask_scratch)
+                seg[z_mid] = segment_from_mask(predictor_, seg_prompt, image_embeddings=image_embeddings, i=z_mid,
+                                               use_mask=use_mask, use_box=use_box)
+                n_segmented += 1
+
+        return n_segmented
 
     z0, z1 = int(segmented_slices.min()), int(segmented_slices.max())
 
+    # collect the segmentation tasks; they operate on disjoint z-ranges,
+    # so they can run concurrently
+    tasks = []
+
     # segment below the min slice
     if z0 > 0 and not stop_lower:
-        segment_range(z0, 0, -1, np.less, iou_threshold)
+        tasks.append((segment_range, z0, 0, -1, np.less, iou_threshold))
 
     # segment above the max slice
     if z1 < seg.shape[0] - 1 and not stop_upper:
-        segment_range(z1, seg.shape[0] - 1, 1, np.greater, iou_threshold)
+        tasks.append((segment_range, z1, seg.shape[0] - 1, 1, np.greater, iou_threshold))
 
-    verbose = False
     # segment in between min and max slice
     if z0 != z1:
         for z_start, z_stop in zip(segmented_slices[:-1], segmented_slices[1:]):
-            slice_diff = z_stop - z_start
-            z_mid = int((z_start + z_stop) // 2)
-
-            if slice_diff == 1:  # the slices are adjacent -> we don't need to do anything
-                pass
-
-            elif z_start == z0 and stop_lower:  # the lower slice is stop: we just segment from upper
-                segment_range(z_stop, z_start, -1, np.less_equal, verbose=verbose)
-
-            elif z_stop == z1 and stop_upper:  # the upper slice is stop: we just segment from lower
-                segment_range(z_start, z_stop, 1, np.greater_equal, verbose=verbose)
-
-            elif slice_diff == 2:  # there is only one slice in between -> use combined mask
-                z = z_start + 1
-                seg_prompt = np.logical_or(seg[z_start] == 1, seg[z_stop] == 1)
-                seg[z] = segment_from_mask(predictor, seg_prompt, image_embeddings=image_embeddings, i=z,
-                                           use_mask=use_mask, use_box=use_box)
-                _update_progress()
-
-            else:  # there is a range of more than 2 slices in between -> segment ranges
-                # segment from bottom
-                segment_range(
-                    z_start, z_mid, 1, np.greater_equal if slice_diff % 2 == 0 else np.greater, verbose=verbose
-                )
-                # segment from top
-                segment_range(z_stop, z_mid, -1, np.less_equal, verbose=verbose)
-                # if the difference between start and stop is even,
-                # then we have a slice in the middle that is the same distance from top bottom
-                # in this case the slice is not segmented in the ranges above, and we segment it
-                # using the combined mask from the adjacent top and bottom slice as prompt
-                if slice_diff % 2 == 0:
-                    seg_prompt = np.logical_or(seg[z_mid - 1] == 1, seg[z_mid + 1] == 1)
-                    seg[z_mid] = segment_from_mask(predictor, seg_prompt, image_embeddings=image_embeddings, i=z_mid,
-                                                   use_mask=use_mask, use_box=use_box)
-                    _update_progress()
+            tasks.append((segment_inbetween, z_start, z_stop))
+
+    def run_task(task):
+        fn, *args = task
+        # set_precomputed mutates the predictor state, so each task runs with its
+        # own shallow predictor copy (sharing the model weights); on gpu each task
+        # gets its own cuda stream, so that the small decoder kernels can overlap
+        predictor_ = copy.copy(predictor)
+        if torch.cuda.is_available():
+            with torch.cuda.stream(torch.cuda.Stream()):
+                return fn(predictor_, *args)
+        else:
+            return fn(predictor_, *args)
+
+    if len(tasks) == 1:
+        _update_progress(run_task(tasks[0]))
+    elif tasks:
+        with futures.ThreadPoolExecutor(max_workers=3) as pool:
+            running = [pool.submit(run_task, task) for task in tasks]
+            # iterating the completed tasks propagates exceptions from the workers
+            # and applies the progress updates on the main thread
+            for task in futures.as_completed(running):
+                _update_progress(task.result())
 
     return seg
 
@@ -313,7 +379,9 @@ def main():
     )
 
     args = parser.parse_args()
-    raw = util.load_image_data(args.input, ndim=3, key=args.key)
+    # load the volume lazily if the embeddings are saved to file; they are computed
+    # slice by slice, so the volume doesn't need to be materialized in memory up front
+    raw = util.load_image_data(args.input, ndim=3, key=args.key, lazy_loading=args.embedding_path is not None)
 
     if args.segmentation_result is None:
         segmentation_result = None
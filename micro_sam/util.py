@@ -1,6 +1,11 @@
 import hashlib
 import os
-from shutil import copyfileobj
+import threading
+import weakref
+import zlib
+from collections import deque, OrderedDict
+from concurrent import futures
+from contextlib import nullcontext
 
 import numpy as np
 import requests
@@ -8,8 +13,10 @@ import torch
 import vigra
 import zarr
 
+from numba import njit
+from numcodecs import Blosc
+
 from elf.io import open_file
-from skimage.measure import regionprops
 
 from segment_anything import sam_model_registry, SamPredictor
 
@@ -35,8 +42,18 @@ CHECKSUMS = {
     "vit_b": "ec2df62732614e57411cdcf32a23ffdf28910380d03139ee0f4fcbe91eb8c912"
 }
 
+# cache the default device at import time; checking for cuda availability is not
+# free and set_precomputed is on the interactive hot path
+_DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+_IS_CUDA = _DEVICE.type == "cuda"
+
 
 def _download(url, path, model_type):
+    # download in large chunks to keep the syscall count low, and hash the stream
+    # on the fly, so that the checkpoint doesn't need to be read from disk again
+    # for the checksum validation (the checkpoints are large, ~2.5 GB for vit_h)
+    chunk_size = 4 * 1024 * 1024
+    sha = hashlib.sha256()
     with requests.get(url, stream=True, verify=True) as r:
         if r.status_code != 200:
             r.raise_for_status()
@@ -45,16 +62,17 @@ def _download(url, path, model_type):
         desc = f"Download {url} to {path}"
         if file_size == 0:
             desc += " (unknown file size)"
-        with tqdm.wrapattr(r.raw, "read", total=file_size, desc=desc) as r_raw, open(path, "wb") as f:
-            copyfileobj(r_raw, f)
+        with tqdm(total=file_size, desc=desc, unit="B", unit_scale=True) as pbar, open(path, "wb") as f:
+            for chunk in r.iter_content(chunk_size=chunk_size):
+                f.write(chunk)
+                sha.update(chunk)
+                pbar.update(len(chunk))
 
     # validate the checksum
     expected_checksum = CHECKSUMS[model_type]
     if expected_checksum is None:
         return
-    with open(path, "rb") as f:
-        file_ = f.read()
-        checksum = hashlib.sha256(file_).hexdigest()
+    checksum = sha.hexdigest()
     if checksum != expected_checksum:
         raise RuntimeError(
             "The checksum of the download does not match the expected checksum."
@@ -95,7 +113,8 @@ def get_sam_model(device=None, model_type="vit_h", checkpoint_path=None, return_
         return_sam [bool] - return the sam model object as well as the predictor (default: False)
     """
     checkpoint = _get_checkpoint(model_type, checkpoint_path)
-    device = "cuda" if torch.cuda.is_available() else "cpu"
+    if device is None:
+        device = _DEVICE
     sam = sam_model_registry[model_type](checkpoint=checkpoint)
     sam.to(device=device)
     predictor = SamPredictor(sam)
@@ -104,16 +123,39 @@ def get_sam_model(device=None, model_type="vit_h", checkpoint_path=None, return_
     return predictor
 
 
+# scratch buffer for the normalization in _to_image; it is reused across calls,
+# so that normalizing many same-sized images (e.g. the slices of a volume)
+# doesn't allocate a full float32 copy per image
+_NORMALIZATION_SCRATCH = None
+
+
+def _get_normalization_scratch(shape):
+    global _NORMALIZATION_SCRATCH
+    if _NORMALIZATION_SCRATCH is None or _NORMALIZATION_SCRATCH.shape != shape:
+        _NORMALIZATION_SCRATCH = np.empty(shape, dtype="float32")
+    return _NORMALIZATION_SCRATCH
+
+
 def _to_image(input_):
     # we require the input to be uint8
     if input_.dtype != np.dtype("uint8"):
-        # first normalize the input to [0, 1]
-        input_ = input_.astype("float32") - input_.min()
-        input_ = input_ / input_.max()
-        # then bring to [0, 255] and cast to uint8
-        input_ = (input_ * 255).astype("uint8")
+        # rescale the input to [0, 255] and cast to uint8
+        # (use in-place operations on a reused float32 buffer to avoid
+        # materializing several full-sized intermediate arrays)
+        mn, mx = input_.min(), input_.max()
+        scale = 255.0 / (float(mx) - float(mn) + 1e-12)
+        scratch = _get_normalization_scratch(input_.shape)
+        # the explicit dtype makes the subtraction run in float32; without it an
+        # integer loop would be selected for integer inputs, which can wrap when
+        # the intensity range exceeds the dtype's maximum
+        np.subtract(input_, mn, out=scratch, dtype="float32")
+        np.multiply(scratch, scale, out=scratch)
+        np.clip(scratch, 0, 255, out=scratch)
+        input_ = scratch.astype("uint8")
     if input_.ndim == 2:
-        image = np.concatenate([input_[..., None]] * 3, axis=-1)
+        # broadcast the grayscale image to rgb instead of concatenating,
+        # which would allocate and copy the image three times
+        image = np.broadcast_to(input_[..., None], input_.shape + (3,))
     elif input_.ndim == 3 and input_.shape[-1] == 3:
         image = input_
     else:
@@ -123,12 +165,18 @@ def _to_image(input_):
 
 def _compute_2d(input_, predictor):
     image = _to_image(input_)
-    predictor.set_image(image)
-    features = predictor.get_image_embedding()
+    with _autocast():
+        predictor.set_image(image)
+    # cast back to float32, the mask decoder runs at full precision
+    features = predictor.get_image_embedding().float()
     original_size = predictor.original_size
     input_size = predictor.input_size
+    # keep the features on the gpu; without a save path they only feed back into
+    # set_precomputed, so a gpu -> cpu -> gpu round-trip would be wasted
+    if not _IS_CUDA:
+        features = features.cpu().numpy()
     image_embeddings = {
-        "features": features.cpu().numpy(), "input_size": input_size, "original_size": original_size,
+        "features": features, "input_size": input_size, "original_size": original_size,
     }
     return image_embeddings
 
@@ -141,8 +189,9 @@ def _precompute_2d(input_, predictor, save_path):
         original_size, input_size = f.attrs["original_size"], f.attrs["input_size"]
     else:
         image = _to_image(input_)
-        predictor.set_image(image)
-        features = predictor.get_image_embedding()
+        with _autocast():
+            predictor.set_image(image)
+        features = predictor.get_image_embedding().float()
         original_size, input_size = predictor.original_size, predictor.input_size
         f.create_dataset("features", data=features.cpu().numpy(), chunks=features.shape)
         f.attrs["input_size"] = input_size
@@ -154,34 +203,128 @@ def _precompute_2d(input_, predictor, save_path):
     return image_embeddings
 
 
-def _compute_3d(input_, predictor):
-    features = []
-    original_size, input_size = None, None
+def _autocast():
+    # run the image encoder in reduced precision on the gpu; the embeddings are
+    # hardly affected by this, but the encoder is about twice as fast on tensor
+    # cores and its activations need half the bandwidth
+    if _IS_CUDA:
+        dtype = torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+        return torch.autocast(device_type="cuda", dtype=dtype)
+    return nullcontext()
+
+
+# number of slices that are passed to the image encoder together in _compute_3d;
+# one batched vit forward is much more efficient than several per-slice forwards,
+# but larger batches also need more gpu memory, so the value can be overridden
+# via the environment variable SAM_BATCH_SIZE
+ENCODER_BATCH_SIZE = int(os.environ.get("SAM_BATCH_SIZE", "4"))
+
+# torch.cuda.OutOfMemoryError was only introduced in torch 1.13
+_OUT_OF_MEMORY_ERROR = getattr(torch.cuda, "OutOfMemoryError", RuntimeError)
+
+
+def _encode_batch(predictor, batch):
+    # replicate the preprocessing of predictor.set_image for all slices of the
+    # batch and run the image encoder on them together
+    device = predictor.device
+    images, original_size, input_size = [], None, None
+
+    for z_slice in batch:
+        # broadcast the slice to rgb without copying it, see _precompute_3d
+        image = np.broadcast_to(z_slice[..., None], z_slice.shape + (3,))
+        image = predictor.transform.apply_image(image)
+        original_size = tuple(z_slice.shape)
+        input_size = tuple(image.shape[:2])
+        image = torch.as_tensor(image, device=device).permute(2, 0, 1).contiguous()
+        images.append(predictor.model.preprocess(image))
+
+    with torch.no_grad(), _autocast():
+        batch = torch.stack(images)
+        # channels-last keeps spatially adjacent pixels adjacent in memory, which
+        # improves the cache behavior of the patch-embedding convolution
+        batch = batch.to(memory_format=torch.channels_last)
+        embeddings = predictor.model.image_encoder(batch)
+    return embeddings.float(), original_size, input_size
+
+
+def _iterate_slices(input_):
+    # iterate the slices of the volume, reading the next slice with a background
+    # thread, so that (lazy) disk i/o overlaps with the work on the current slice
+    n_slices = input_.shape[0]
+    if n_slices == 0:
+        return
+    with futures.ThreadPoolExecutor(max_workers=1) as pool:
+        next_slice = pool.submit(lambda z: np.asarray(input_[z]), 0)
+        for z in range(n_slices):
+            z_slice = next_slice.result()
+            if z + 1 < n_slices:
+                next_slice = pool.submit(lambda z: np.asarray(input_[z]), z + 1)
+            yield z_slice
 
-    for z_slice in tqdm(input_, desc="Precompute Image Embeddings"):
-        predictor.reset_image()
 
-        # preprocess the image
-        image = np.concatenate([z_slice[..., None]] * 3, axis=-1)
+def _hash_slice(z_slice):
+    # cheap content hash to detect duplicate slices (e.g. blank padding slices in
+    # a z-stack); adler32 and crc32 are combined to make collisions unlikely
+    data = np.ascontiguousarray(z_slice)
+    return str(data.dtype), data.shape, zlib.adler32(data), zlib.crc32(data)
 
-        predictor.set_image(image)
-        embedding = predictor.get_image_embedding()
-        features.append(embedding[None])
 
-        if original_size is None:
-            original_size = predictor.original_size
-        if input_size is None:
-            input_size = predictor.input_size
+def _compute_3d(input_, predictor):
+    n_slices = input_.shape[0]
+
+    # detect duplicate slices with a cheap content hash,
+    # so that the encoder only runs once per unique slice
+    slice_index = np.zeros(n_slices, dtype="int64")
+    unique_slices, seen = [], {}
+    for z, z_slice in enumerate(_iterate_slices(input_)):
+        key = _hash_slice(z_slice)
+        index = seen.get(key)
+        if index is None:
+            index = len(unique_slices)
+            seen[key] = index
+            unique_slices.append(z_slice)
+        slice_index[z] = index
+
+    features = []
+    original_size, input_size = None, None
 
-    # concatenate across the z axis
-    features = torch.cat(features)
+    batch_size = ENCODER_BATCH_SIZE
+    with tqdm(total=len(unique_slices), desc="Precompute Image Embeddings") as pbar:
+        z_start = 0
+        while z_start < len(unique_slices):
+            batch = unique_slices[z_start:z_start + batch_size]
+            try:
+                embeddings, original_size, input_size = _encode_batch(predictor, batch)
+            except _OUT_OF_MEMORY_ERROR:
+                if len(batch) == 1:
+                    raise
+                # the batch doesn't fit into gpu memory,
+                # fall back to encoding slice by slice for the rest of the volume
+                print(f"The encoder ran out of memory for batch size {batch_size}, continuing with single slices.")
+                batch_size = 1
+                torch.cuda.empty_cache()
+                continue
+            features.append(embeddings)
+            pbar.update(len(embeddings))
+            z_start += len(batch)
+
+    # concatenate across the z axis, expand the duplicated slices
+    # and restore the per-slice singleton axis
+    features = torch.cat(features)[torch.from_numpy(slice_index)][:, None]
+    # keep the features on the gpu, see _compute_2d
+    if not _IS_CUDA:
+        features = features.cpu().numpy()
 
     image_embeddings = {
-        "features": features.cpu().numpy(), "input_size": input_size, "original_size": original_size,
+        "features": features, "input_size": input_size, "original_size": original_size,
     }
     return image_embeddings
 
 
+def _write_embedding(features, z, embedding):
+    features[z] = embedding.cpu().numpy()
+
+
 def _precompute_3d(input_, predictor, save_path, lazy_loading):
     f = zarr.open(save_path, "a")
 
@@ -190,26 +333,65 @@ def _precompute_3d(input_, predictor, save_path, lazy_loading):
         original_size, input_size = f.attrs["original_size"], f.attrs["input_size"]
 
     else:
-        features = f["features"] if "features" in f else None
         original_size, input_size = None, None
 
-        for z, z_slice in tqdm(enumerate(input_), total=input_.shape[0], desc="Precompute Image Embeddings"):
-            if features is not None:
-                emb = features[z]
-                if np.count_nonzero(emb) != 0:
+        # the embedding shape is fixed by the model architecture, so the dataset
+        # can be created up front instead of on the first loop iteration
+        if "features" in f:
+            features = f["features"]
+        else:
+            embed_dim = predictor.model.prompt_encoder.embed_dim
+            embed_size = tuple(predictor.model.prompt_encoder.image_embedding_size)
+            shape = (input_.shape[0], 1, embed_dim) + embed_size
+            chunks = (1, 1, embed_dim) + embed_size
+            # the embeddings are stored in float16, which halves the size on disk
+            # and is precise enough for the mask decoder; bitshuffle + zstd
+            # compresses them well at low cpu cost
+            compressor = Blosc(cname="zstd", clevel=1, shuffle=Blosc.BITSHUFFLE)
+            features = f.create_dataset(
+                "features", shape=shape, chunks=chunks, dtype="float16", compressor=compressor
+            )
+
+        # the embeddings are written to zarr by a background thread, so that the
+        # device transfer, compression and disk i/o overlap with the encoder pass
+        # for the next slice; we keep at most two writes in flight to bound memory
+        with futures.ThreadPoolExecutor(max_workers=2) as pool:
+            pending = deque()
+            seen = {}
+
+            for z, z_slice in tqdm(
+                enumerate(_iterate_slices(input_)), total=input_.shape[0], desc="Precompute Image Embeddings"
+            ):
+                # skip the slice if its embedding was already computed in a previous run
+                if np.count_nonzero(features[z]) != 0:
                     continue
 
-            predictor.reset_image()
-            image = np.concatenate([z_slice[..., None]] * 3, axis=-1)
-            predictor.set_image(image)
-            embedding = predictor.get_image_embedding()
+                # if the slice is a duplicate (e.g. a blank padding slice) re-use the
+                # embedding that was already computed for it; the pending writes are
+                # drained first, so we don't read back a slot that is still in flight
+                key = _hash_slice(z_slice)
+                z_prev = seen.get(key)
+                if z_prev is not None:
+                    while pending:
+                        pending.popleft().result()
+                    features[z] = features[z_prev]
+                    continue
+                seen[key] = z
 
-            original_size, input_size = predictor.original_size, predictor.input_size
-            if features is None:
-                shape = (input_.shape[0],) + embedding.shape
-                chunks = (1,) + embedding.shape
-                features = f.create_dataset("features", shape=shape, chunks=chunks, dtype="float32")
-            features[z] = embedding.cpu().numpy()
+                predictor.reset_image()
+                # broadcast the slice to rgb without copying it, see _encode_batch
+                image = np.broadcast_to(z_slice[..., None], z_slice.shape + (3,))
+                with _autocast():
+                    predictor.set_image(image)
+                embedding = predictor.get_image_embedding().float()
+                original_size, input_size = predictor.original_size, predictor.input_size
+
+                while len(pending) >= 2:
+                    pending.popleft().result()
+                pending.append(pool.submit(_write_embedding, features, z, embedding))
+
+            while pending:
+                pending.popleft().result()
 
         f.attrs["input_size"] = input_size
         f.attrs["original_size"] = original_size
@@ -253,6 +435,37 @@ def precompute_image_embeddings(predictor, input_, save_path=None, lazy_loading=
     return image_embeddings
 
 
+# cache for the device tensors of recently used embeddings, so that re-visiting
+# a slice during interactive annotation doesn't pay the host to device transfer
+# again; the keys are based on object identity, so each entry is validated with
+# a weakref to guard against recycled ids
+_FEATURE_CACHE = OrderedDict()
+_FEATURE_CACHE_SIZE = 32
+# set_precomputed may be called from several threads, see _segment_volume
+_FEATURE_CACHE_LOCK = threading.Lock()
+
+
+def _features_to_device(features, i, device):
+    key = (id(features), i)
+    with _FEATURE_CACHE_LOCK:
+        cached = _FEATURE_CACHE.get(key)
+        if cached is not None:
+            ref, tensor = cached
+            if ref() is features:
+                _FEATURE_CACHE.move_to_end(key)
+                return tensor
+            del _FEATURE_CACHE[key]
+    tensor = torch.from_numpy(features if i is None else features[i]).to(device)
+    # the embeddings may be stored in float16, but the mask decoder runs at full precision
+    if tensor.dtype != torch.float32:
+        tensor = tensor.float()
+    with _FEATURE_CACHE_LOCK:
+        _FEATURE_CACHE[key] = (weakref.ref(features), tensor)
+        if len(_FEATURE_CACHE) > _FEATURE_CACHE_SIZE:
+            _FEATURE_CACHE.popitem(last=False)
+    return tensor
+
+
 def set_precomputed(predictor, image_embeddings, i=None):
     """Set the precomputed image embeddings.
 
@@ -263,7 +476,9 @@ def set_precomputed(predictor, image_embeddings, i=None):
         i [int] - the index for the image embeddings for 3D data.
             Only needs to be passed for 3d data. (default: None)
     """
-    device = "cuda" if torch.cuda.is_available() else "cpu"
+    # use the device of the predictor, which may differ from the default device
+    # if an explicit device was passed to get_sam_model
+    device = predictor.device
     features = image_embeddings["features"]
 
     assert features.ndim in (4, 5)
@@ -272,12 +487,10 @@ def set_precomputed(predictor, image_embeddings, i=None):
     elif features.ndim == 4 and i is not None:
         raise ValueError("The data is 2D so an index is not needed.")
 
-    if i is None:
-        predictor.features = features.to(device) if torch.is_tensor(features) else \
-            torch.from_numpy(features).to(device)
+    if torch.is_tensor(features):
+        predictor.features = (features if i is None else features[i]).to(device)
     else:
-        predictor.features = features[i].to(device) if torch.is_tensor(features) else \
-            torch.from_numpy(features[i]).to(device)
+        predictor.features = _features_to_device(features, i, device)
     predictor.original_size = image_embeddings["original_size"]
     predictor.input_size = image_embeddings["input_size"]
     predictor.is_image_set = True
@@ -285,44 +498,154 @@ def set_precomputed(predictor, image_embeddings, i=None):
     return predictor
 
 
+@njit(cache=True)
+def _iou_counts(mask1, mask2):
+    # count intersection and union in a single fused pass over the flat masks,
+    # instead of materializing the boolean arrays and reducing them separately;
+    # deliberately not parallel=True: the kernel is called concurrently from the
+    # segmentation tasks in _segment_volume and numba's workqueue threading
+    # layer (the fallback without tbb/openmp) is not thread-safe
+    overlap, union = 0, 0
+    for i in range(mask1.size):
+        is_foreground1 = mask1[i] == 1
+        is_foreground2 = mask2[i] == 1
+        if is_foreground1 and is_foreground2:
+            overlap += 1
+        if is_foreground1 or is_foreground2:
+            union += 1
+    return overlap, union
+
+
+@njit(cache=True)
+def _mask_union_impl(mask1, mask2, out):
+    # not parallel=True for the same reason as _iou_counts
+    for i in range(mask1.size):
+        out[i] = (mask1[i] == 1) | (mask2[i] == 1)
+
+
+def _mask_union(mask1, mask2, out=None):
+    # fused equivalent of np.logical_or(mask1 == 1, mask2 == 1); avoids the two
+    # boolean temporaries and supports a reusable output buffer
+    if out is None:
+        out = np.empty(mask1.shape, dtype="bool")
+    _mask_union_impl(mask1.ravel(), mask2.ravel(), out.ravel())
+    return out
+
+
 def compute_iou(mask1, mask2):
     """Compute the intersection over union of two masks.
     """
-    overlap = np.logical_and(mask1 == 1, mask2 == 1).sum()
-    union = np.logical_or(mask1 == 1, mask2 == 1).sum()
+    # np.any short-circuits on the first non-zero entry, so this skips the full
+    # reduction in the common case that a segmentation has died out completely
+    if not (mask1.any() and mask2.any()):
+        return 0.0
+    overlap, union = _iou_counts(mask1.ravel(), mask2.ravel())
     eps = 1e-7
     iou = float(overlap) / (float(union) + eps)
     return iou
 
 
+@njit(cache=True)
+def _centroids_and_bboxes_impl(labels, shape, n_labels):
+    # accumulate the per-label pixel counts, coordinate sums (for the centroids)
+    # and coordinate extrema (for the bounding boxes) in a single pass over the
+    # flat label array; the nd coordinates are recovered from the flat index
+    ndim = shape.size
+    count = np.zeros(n_labels + 1, dtype=np.int64)
+    sums = np.zeros((n_labels + 1, ndim), dtype=np.float64)
+    mins = np.empty((n_labels + 1, ndim), dtype=np.int64)
+    maxs = np.zeros((n_labels + 1, ndim), dtype=np.int64)
+    for d in range(ndim):
+        mins[:, d] = shape[d]
+    coord = np.zeros(ndim, dtype=np.int64)
+    for i in range(labels.size):
+        label = labels[i]
+        if label == 0:
+            continue
+        rest = i
+        for d in range(ndim - 1, -1, -1):
+            coord[d] = rest % shape[d]
+            rest //= shape[d]
+        count[label] += 1
+        for d in range(ndim):
+            c = coord[d]
+            sums[label, d] += c
+            if c < mins[label, d]:
+                mins[label, d] = c
+            if c + 1 > maxs[label, d]:
+                maxs[label, d] = c + 1
+    return count, sums, mins, maxs
+
+
 def get_cell_center_coordinates(gt, mode="v"):
     """
     Returns the center coordinates of the foreground instances in the ground-truth
     """
-    assert mode in ["p", "v"], "Choose either 'p' for regionprops or 'v' for vigra"
+    assert mode in ["p", "v"], "Choose either 'p' for centroids or 'v' for vigra"
 
-    properties = regionprops(gt)
+    # compute the centroids and bounding boxes in a single pass over the labels
+    # instead of scanning them separately with regionprops and vigra
+    n_labels = int(gt.max())
+    shape = np.array(gt.shape, dtype="int64")
+    count, sums, mins, maxs = _centroids_and_bboxes_impl(gt.ravel(), shape, n_labels)
+    foreground_ids = [label_id for label_id in range(1, n_labels + 1) if count[label_id] > 0]
 
     if mode == "p":
-        center_coordinates = {prop.label: prop.centroid for prop in properties}
+        center_coordinates = {
+            label_id: tuple(sums[label_id] / count[label_id]) for label_id in foreground_ids
+        }
     elif mode == "v":
         center_coordinates = vigra.filters.eccentricityCenters(gt.astype('float32'))
         center_coordinates = {i: coord for i, coord in enumerate(center_coordinates) if i > 0}
 
-    bbox_coordinates = {prop.label: prop.bbox for prop in properties}
+    bbox_coordinates = {
+        label_id: tuple(mins[label_id]) + tuple(maxs[label_id]) for label_id in foreground_ids
+    }
 
     assert len(bbox_coordinates) == len(center_coordinates)
     return center_coordinates, bbox_coordinates
 
 
+def _compile_kernels():
+    # eagerly compile the numba kernels for the most common dtypes, so that the
+    # first interactive call doesn't hit the jit compilation latency (several
+    # hundred ms without a warm cache); other dtypes still compile on demand
+    from numba import types
+
+    flat_bool = types.Array(types.boolean, 1, "C")
+    flat_uint32 = types.Array(types.uint32, 1, "C")
+    # the annotators compare uint32 label slices with the boolean masks
+    # predicted by SAM, hence the mixed signatures
+    for sig1, sig2 in [
+        (flat_bool, flat_bool), (flat_uint32, flat_uint32),
+        (flat_uint32, flat_bool), (flat_bool, flat_uint32),
+    ]:
+        _iou_counts.compile((sig1, sig2))
+        _mask_union_impl.compile((sig1, sig2, flat_bool))
+    flat_int64 = types.Array(types.int64, 1, "C")
+    for dtype in (types.uint16, types.uint32, types.int64):
+        _centroids_and_bboxes_impl.compile((types.Array(dtype, 1, "C"), flat_int64, types.int64))
+
+
+_compile_kernels()
+
+
 def load_image_data(path, ndim, key=None, lazy_loading=False):
     if key is None:
         image_data = imageio.imread(path) if ndim == 2 else imageio.volread(path)
+    elif lazy_loading:
+        # don't close the file, otherwise the returned dataset handle would be
+        # invalidated for hdf5 and mrc inputs; attach the handle to the dataset
+        # instead, so the file stays open for as long as the data is in use
+        f = open_file(path, mode="r")
+        image_data = f[key]
+        try:
+            image_data._micro_sam_file_handle = f
+        except AttributeError:  # not all backends support setting attributes
+            pass
     else:
         with open_file(path, mode="r") as f:
-            image_data = f[key]
-            if not lazy_loading:
-                image_data = image_data[:]
+            image_data = f[key][:]
     return image_data
 
 
@@ -1,4 +1,5 @@
 import numpy as np
+import torch
 from elf.segmentation.embeddings import embedding_pca
 
 
@@ -19,6 +20,9 @@ def compute_pca(embeddings):
 
 
 def project_embeddings_for_visualization(embeddings, shape):
+    # the embeddings may still live on the gpu if they were not saved to file
+    if torch.is_tensor(embeddings):
+        embeddings = embeddings.cpu().numpy()
     assert embeddings.ndim == len(shape) + 2, f"{embeddings.shape}, {shape}"
 
     def get_crop(embedding_vis, shape):
@@ -1,3 +1,5 @@
+import os
+import tempfile
 import unittest
 
 import numpy as np
@@ -19,6 +21,66 @@ class TestUtil(unittest.TestCase):
             x1, x2 = (np.random.rand(32, 32) > 0.5), (np.random.rand(32, 32) > 0.5)
             self.assertTrue(0.0 < compute_iou(x1, x2) < 1.0)
 
+    def test_mask_union(self):
+        from micro_sam.util import _mask_union
+
+        for dtype in ("bool", "uint8", "uint32"):
+            x1 = (np.random.rand(64, 64) > 0.5).astype(dtype)
+            x2 = (np.random.rand(64, 64) > 0.5).astype(dtype)
+            expected = np.logical_or(x1 == 1, x2 == 1)
+            self.assertTrue(np.array_equal(_mask_union(x1, x2), expected))
+
+        # only the label value 1 counts as foreground
+        x1 = np.zeros((16, 16), dtype="uint32")
+        x1[:4] = 2
+        x1[4:8] = 1
+        x2 = np.zeros((16, 16), dtype="uint32")
+        x2[8:12] = 1
+        expected = np.logical_or(x1 == 1, x2 == 1)
+
+        # the result is written to the passed output buffer
+        out = np.empty(x1.shape, dtype="bool")
+        result = _mask_union(x1, x2, out=out)
+        self.assertIs(result, out)
+        self.assertTrue(np.array_equal(result, expected))
+
+    def test_hash_slice(self):
+        from micro_sam.util import _hash_slice
+
+        # slices with equal content hash equal, so they share one embedding
+        x = np.random.rand(32, 32).astype("float32")
+        self.assertEqual(_hash_slice(x), _hash_slice(x.copy()))
+
+        # any change in content must change the hash
+        y = x.copy()
+        y[0, 0] += 1
+        self.assertNotEqual(_hash_slice(x), _hash_slice(y))
+
+        # equal bytes with different dtype or shape must not be treated as duplicates
+        self.assertNotEqual(_hash_slice(x), _hash_slice(x.view("uint32")))
+        self.assertNotEqual(_hash_slice(x), _hash_slice(x.reshape(64, 16)))
+
+        # non-contiguous slices hash like their contiguous copy
+        self.assertEqual(_hash_slice(x[:, ::2]), _hash_slice(x[:, ::2].copy()))
+
+    def test_float16_embedding_roundtrip(self):
+        import torch
+        import zarr
+        from micro_sam.util import _features_to_device
+
+        values = np.random.randn(2, 1, 8, 16, 16).astype("float32")
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            f = zarr.open(os.path.join(tmp_dir, "embeddings.zarr"), "a")
+            f.create_dataset("features", data=values.astype("float16"), chunks=(1,) + values.shape[1:])
+            features = f["features"]
+
+            tensor = _features_to_device(features, 0, "cpu")
+            # the features are cast back to float32 for the mask decoder
+            self.assertEqual(tensor.dtype, torch.float32)
+            self.assertTrue(np.allclose(tensor.numpy(), values[0], atol=1e-2))
+            # repeated access to the same slice is served from the cache
+            self.assertIs(_features_to_device(features, 0, "cpu"), tensor)
+
 
 if __name__ == "__main__":
     unittest.main()